@@ -0,0 +1,367 @@
+from typing import Dict, Optional
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+import time
+import base64
+import threading
+
+import google_crc32c
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from tqdm import tqdm
+
+# A single session so connections (and their TLS handshakes) are reused across all requests.
+SESSION = requests.Session()
+# No explicit Accept-Encoding: requests advertises brotli (by far the best ratio on these JSON
+# files) as soon as it is installed, which is why it is a dependency. The same goes for zstd,
+# with the `zstd` extra, which needs urllib3 2.
+SESSION.headers["User-Agent"] = "helmdd (+https://github.com/wschella/helm-data-downloader)"
+
+
+class ConcurrencyLimit:
+    """
+    Limits the number of concurrent downloads, and halves that limit when the server throttles us.
+
+    The limit grows back by one for every `limit` downloads that finish, up to `maximum` again.
+    """
+
+    def __init__(self, maximum: int):
+        self.maximum = maximum
+        self.limit = maximum
+        self.active = 0
+        self.finished = 0
+        self.throttled_at = float("-inf")
+        self.condition = threading.Condition()
+
+    def __enter__(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    def __exit__(self, *exc_info):
+        with self.condition:
+            self.active -= 1
+            self.finished += 1
+            if self.finished >= self.limit and self.limit < self.maximum:
+                self.limit += 1
+                self.finished = 0
+            self.condition.notify_all()
+
+    def throttle(self):
+        with self.condition:
+            # All requests in flight are likely to be throttled together, so only count that once.
+            if time.monotonic() - self.throttled_at > 1.0:
+                self.limit = max(1, self.limit // 2)
+                self.finished = 0
+                self.throttled_at = time.monotonic()
+
+
+LIMIT = ConcurrencyLimit(64)
+# Set when downloading is interrupted, so the downloads in flight stop instead of finishing.
+ABORT = threading.Event()
+
+
+class DownloadAborted(Exception):
+    """Raised in a download that is stopped early because downloading was interrupted."""
+
+
+def stop_if_aborted():
+    if ABORT.is_set():
+        raise DownloadAborted()
+
+
+class ThrottlingRetry(Retry):
+    """Retry policy that also lowers the concurrency `LIMIT` when the server throttles us."""
+
+    def increment(self, method=None, url=None, response=None, error=None, *args, **kwargs):
+        if response is not None and response.status in (429, 503):
+            LIMIT.throttle()
+        stop_if_aborted()  # Neither wait for nor make a retry after an interrupt.
+        return super().increment(method, url, response, error, *args, **kwargs)
+
+
+# Transient errors are common when downloading many files from a shared bucket, so retry them
+# generously. The random jitter keeps the workers that failed together from retrying together.
+# When retries run out, the last response is returned as usual, so callers can report it.
+RETRY = ThrottlingRetry(
+    total=10,
+    backoff_factor=0.5,
+    backoff_jitter=0.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=frozenset({"GET", "HEAD"}),
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+
+
+def size_connection_pool(pool_maxsize: int):
+    """(Re)mount the session's adapters so that up to `pool_maxsize` connections are kept alive."""
+    replaced = set(SESSION.adapters.values())
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=pool_maxsize, max_retries=RETRY)
+    SESSION.mount("https://", adapter)
+    SESSION.mount("http://", adapter)
+    # Closing the session only closes the adapters mounted last, so close the replaced ones now.
+    for old_adapter in replaced:
+        old_adapter.close()
+
+
+size_connection_pool(64)
+
+# Lists every downloaded file as "<run dir>/<file name>", one per line.
+MANIFEST_NAME = ".manifest"
+CHUNK_SIZE = 1024 * 1024
+# (connect, read) timeouts in seconds for every request, so a stalled connection cannot keep a
+# worker, and with it the whole download, waiting forever. Timed out requests are retried.
+TIMEOUT = (10, 30)
+# Large files are downloaded as this many byte ranges in parallel, of at least the given size.
+MAX_PARTS = 4
+MIN_PART_SIZE = 4 * 1024 * 1024
+
+
+def download_files(
+    jobs: list[tuple[str, Path]],
+    output_dir: Path,
+    workers: int,
+    indexed: Dict[str, set[str]],
+):
+    """
+    Download all (url, path) jobs, with `workers` downloads in flight at once.
+
+    Downloading is bound by network latency, not bandwidth, so many files are kept in flight.
+    Fewer are when the server asks us to slow down. Every file that is complete afterwards, written
+    or found unchanged, is recorded in the manifest of `output_dir`, unless it is in the `indexed`
+    files of its run directory already (see `index_downloaded`).
+    When interrupted, the downloads in flight are stopped too, and left to be resumed next time.
+    """
+    global LIMIT
+    # requests cannot multiplex over HTTP/2, so give every worker its own keep-alive connection
+    # (one per part for large files). With a smaller pool, connections are closed and reopened.
+    size_connection_pool(workers * MAX_PARTS)
+    # Create all run directories up front, instead of once for every file in them.
+    for run_dir in {path.parent for _, path in jobs}:
+        run_dir.mkdir(parents=True, exist_ok=True)
+    LIMIT = ConcurrencyLimit(workers)
+    ABORT.clear()
+
+    manifest_lock = threading.Lock()
+
+    def download_limited(url: str, path: Path):
+        with LIMIT:
+            stop_if_aborted()
+            download_file(url, path)
+        if path.name in indexed.get(path.parent.name, ()):
+            return
+        # Record the file as soon as it is in place, so downloads that complete while we are
+        # being interrupted are recorded too.
+        with manifest_lock:
+            manifest.write(f"{path.parent.name}/{path.name}\n")
+
+    # The manifest is closed only after the executor has waited for every running download.
+    with open(output_dir / MANIFEST_NAME, "a") as manifest, ThreadPoolExecutor(workers) as executor:
+        futures = [executor.submit(download_limited, url, path) for url, path in jobs]
+        try:
+            # Redraw at most twice a second and not at all when not in a terminal (e.g. in CI logs).
+            progress = tqdm(
+                as_completed(futures),
+                total=len(futures),
+                unit="file",
+                mininterval=0.5,
+                miniters=max(1, len(futures) // 200),
+                disable=None,
+            )
+            for future in progress:
+                future.result()
+        except BaseException:
+            ABORT.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+
+def index_downloaded(
+    output_dir: Path, rescan: bool = False, save: bool = True
+) -> Dict[str, set[str]]:
+    """
+    List the files present in every run directory in `output_dir`, keyed by directory name.
+
+    This is read from the manifest in `output_dir` in one go, instead of listing every run
+    directory, which is slow on network file systems. If there is no manifest yet, or `rescan` is
+    set, every run directory is listed once and the manifest is rebuilt from that, unless `save`
+    is not set (e.g. for a dry run).
+    """
+    manifest_path = output_dir / MANIFEST_NAME
+    index: Dict[str, set[str]] = {}
+    if manifest_path.exists() and not rescan:
+        with open(manifest_path) as manifest:
+            for line in manifest:
+                run_dir, _, file_name = line.rstrip("\n").partition("/")
+                index.setdefault(run_dir, set()).add(file_name)
+        return index
+
+    for dir_path, dir_names, file_names in os.walk(output_dir):
+        if dir_path != str(output_dir):
+            index[os.path.basename(dir_path)] = set(file_names)
+            dir_names.clear()  # Run directories have no subdirectories worth listing.
+    if not save:
+        return index
+
+    tmp_path = manifest_path.with_name(f"{MANIFEST_NAME}.tmp")
+    with open(tmp_path, "w") as manifest:
+        for run_dir, files in index.items():
+            manifest.writelines(f"{run_dir}/{file_name}\n" for file_name in files)
+    os.replace(tmp_path, manifest_path)
+    return index
+
+
+def download_file(url: str, path: Path) -> bool:
+    """
+    Download a single file, leaving a `.error` file with the response next to it on failure.
+    Returns whether the file was (re)written.
+
+    The ETag of every downloaded file is stored next to it in a `.etag` file. If the file is
+    already present, it is only downloaded again when the server reports that it changed.
+    An interrupted download is resumed where it stopped, unless the file changed in the meantime.
+    Downloads are verified against the CRC32C checksum that Google Cloud Storage reports.
+    """
+    etag_path = path.with_name(f"{path.name}.etag")
+    # Write to a temporary file first, so an interrupted download never looks complete.
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    # The ETag of the partial download in `tmp_path`, present only if it can be resumed.
+    tmp_etag_path = path.with_name(f"{path.name}.tmp.etag")
+    headers = {}
+    if path.exists() and etag_path.exists():
+        headers["If-None-Match"] = etag_path.read_text()
+    elif tmp_path.exists() and tmp_etag_path.exists():
+        headers["Range"] = f"bytes={tmp_path.stat().st_size}-"
+        headers["If-Range"] = tmp_etag_path.read_text()
+        headers["Accept-Encoding"] = "identity"
+
+    # Stream to disk so at most one chunk per worker is held in memory.
+    with SESSION.get(url, headers=headers, stream=True, timeout=TIMEOUT) as file:
+        if file.status_code == 304:
+            return False
+        if file.status_code == 416:
+            # Nothing is left after the partial download. If it is as long as the file, which has
+            # not changed (If-Range), it may be complete but never moved into place. It is moved
+            # now if it has the file's checksum too, and downloaded again otherwise.
+            if file.headers.get("Content-Range") == f"bytes */{tmp_path.stat().st_size}":
+                head_headers = {"If-Match": headers["If-Range"], "Accept-Encoding": "identity"}
+                head = SESSION.head(url, headers=head_headers, timeout=TIMEOUT)
+                expected_checksum = get_crc32c(head.headers)
+                if head.status_code == 200 and expected_checksum is not None:
+                    checksum = google_crc32c.Checksum()
+                    with open(tmp_path, "rb") as f:
+                        for _ in checksum.consume(f, CHUNK_SIZE):
+                            pass
+                    if checksum.digest() == expected_checksum:
+                        os.replace(tmp_path, path)
+                        os.replace(tmp_etag_path, etag_path)
+                        return True
+            os.remove(tmp_etag_path)
+            return download_file(url, path)
+        if file.status_code not in (200, 206):
+            with open(path.with_name(f"{path.name}.error"), "wb") as f:
+                f.write(file.content)
+            file.raise_for_status()
+            raise requests.HTTPError(f"Unexpected {file.status_code} for {url}.", response=file)
+
+        file.raw.decode_content = True
+        size = int(file.headers.get("Content-Length", 0))
+        encoded = "Content-Encoding" in file.headers
+        splittable = file.headers.get("Accept-Ranges") == "bytes" and not encoded
+        checksum = google_crc32c.Checksum()
+        if file.status_code == 206:
+            # Resume the partial download (If-Range gets us a 200 instead if the file changed).
+            with open(tmp_path, "rb") as f:
+                for _ in checksum.consume(f, CHUNK_SIZE):
+                    pass
+            with open(tmp_path, "ab") as f:
+                for chunk in checksum.consume(file.raw, CHUNK_SIZE):
+                    stop_if_aborted()
+                    f.write(chunk)
+        elif splittable and size >= 2 * MIN_PART_SIZE:
+            tmp_etag_path.unlink(missing_ok=True)
+            download_parts(file, url, tmp_path, size)
+            with open(tmp_path, "rb") as f:
+                for _ in checksum.consume(f, CHUNK_SIZE):
+                    pass
+        else:
+            # Only files that are stored as is can be resumed: ranges are of the stored bytes.
+            if splittable and "ETag" in file.headers:
+                tmp_etag_path.write_text(file.headers["ETag"])
+            else:
+                tmp_etag_path.unlink(missing_ok=True)
+            with open(tmp_path, "wb") as f:
+                for chunk in checksum.consume(file.raw, CHUNK_SIZE):
+                    stop_if_aborted()
+                    f.write(chunk)
+
+        # The checksum is of the stored bytes, which only match ours if nothing was decoded.
+        expected_checksum = get_crc32c(file.headers)
+        if not encoded and expected_checksum is not None:
+            if checksum.digest() != expected_checksum:
+                os.remove(tmp_path)
+                tmp_etag_path.unlink(missing_ok=True)
+                raise Exception(f"Checksum mismatch for {path.name} from {url}.")
+        os.replace(tmp_path, path)
+        tmp_etag_path.unlink(missing_ok=True)
+        if "ETag" in file.headers:
+            etag_path.write_text(file.headers["ETag"])
+        return True
+
+
+def get_crc32c(headers) -> Optional[bytes]:
+    """Get the CRC32C checksum of a file as reported by Google Cloud Storage, if any."""
+    # E.g. "x-goog-hash: crc32c=n03x6A==,md5=Ojk9c3dhfxgoKVVHYwFbHQ==".
+    for file_hash in headers.get("x-goog-hash", "").split(","):
+        name, _, value = file_hash.strip().partition("=")
+        if name == "crc32c":
+            return base64.b64decode(value)
+    return None
+
+
+def download_parts(response: requests.Response, url: str, path: Path, size: int):
+    """
+    Download a large file as multiple byte ranges in parallel, each written in place into `path`.
+
+    A single connection's throughput is limited, which makes the largest files dominate the total
+    download time. The first part is read from the already open `response` for the whole file.
+    """
+    part_size = -(-size // min(MAX_PARTS, size // MIN_PART_SIZE))
+    # Make sure every part comes from the same version of the file, in the same encoding.
+    headers = {"Accept-Encoding": "identity"}
+    if "ETag" in response.headers:
+        headers["If-Match"] = response.headers["ETag"]
+    with open(path, "wb") as f:
+        f.truncate(size)
+
+    def download_part(start: int):
+        length = min(part_size, size - start)
+        if start == 0:
+            copy_part(response.raw, path, start, length)
+            return
+        range_headers = {**headers, "Range": f"bytes={start}-{start + length - 1}"}
+        with SESSION.get(url, headers=range_headers, stream=True, timeout=TIMEOUT) as part:
+            part.raise_for_status()
+            if part.status_code != 206:
+                message = f"Could not download bytes {start}+{length} from {url}."
+                raise requests.HTTPError(message, response=part)
+            copy_part(part.raw, path, start, length)
+
+    with ThreadPoolExecutor(max_workers=MAX_PARTS) as executor:
+        for _ in executor.map(download_part, range(0, size, part_size)):
+            pass
+
+
+def copy_part(source, path: Path, start: int, length: int):
+    """Copy exactly `length` bytes from `source` to `path`, starting at offset `start`."""
+    with open(path, "r+b") as f:
+        f.seek(start)
+        while length > 0:
+            stop_if_aborted()
+            chunk = source.read(min(length, CHUNK_SIZE))
+            if not chunk:
+                raise Exception(f"Download of {path.name} ended early.")
+            f.write(chunk)
+            length -= len(chunk)
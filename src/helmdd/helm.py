@@ -1,14 +1,17 @@
-from typing import Callable, Optional, TypedDict, Dict
+from typing import Callable, NoReturn, Optional, TypedDict, Dict
 from pathlib import Path
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import re
 import sys
-import json
 import urllib.parse
 import argparse
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
-from tqdm import tqdm
+import ijson
+import orjson
+
+from helmdd.download import SESSION, TIMEOUT, download_files, index_downloaded
 
 FILES = [
     "run_spec.json",
@@ -19,34 +22,47 @@ FILES = [
     "display_predictions.json",
     "display_requests.json",
 ]
+# The same files, from largest to smallest, as in the example run in examples/run/.
+FILES_BY_SIZE = [
+    "scenario_state.json",
+    "display_requests.json",
+    "display_predictions.json",
+    "instances.json",
+    "stats.json",
+    "run_spec.json",
+    "scenario.json",
+]
 PROJECTS = ["classic", "heim", "lite", "instruct"]
+STORAGE_URL_RE = re.compile(r'window.BENCHMARK_OUTPUT_BASE_URL =\s+"(.*)";')
+RELEASE_RE = re.compile(r'window.RELEASE = "(.+)";')
+SUITE_RE = re.compile(r'window.SUITE = "(.+)";')
 
 
 class ProjectInfo(TypedDict):
     name: str
-    release_regex: str
+    release_regex: re.Pattern
     get_release_url: Callable[[str, str], str]
 
 
 PROJECT_INFO: Dict[str, ProjectInfo] = {
     "classic": {
         "name": "Classic",
-        "release_regex": r'window.RELEASE = "(.+)";',
+        "release_regex": RELEASE_RE,
         "get_release_url": lambda storage_url, release: f"{storage_url}/releases/{release}",
     },
     "heim": {
         "name": "HEIM",
-        "release_regex": r'window.SUITE = "(.+)";',
+        "release_regex": SUITE_RE,
         "get_release_url": lambda storage_url, release: f"{storage_url}/runs/{release}",
     },
     "lite": {
         "name": "Lite",
-        "release_regex": r'window.RELEASE = "(.+)";',
+        "release_regex": RELEASE_RE,
         "get_release_url": lambda storage_url, release: f"{storage_url}/releases/{release}",
     },
     "instruct": {
         "name": "Instruct",
-        "release_regex": r'window.RELEASE = "(.+)";',
+        "release_regex": RELEASE_RE,
         "get_release_url": lambda storage_url, release: f"{storage_url}/releases/{release}",
     },
 }
@@ -63,22 +79,41 @@ class Args:
     redownload: bool
     max_runs: Optional[int]
     dry_run: bool
+    rescan: bool
     files: list[str]
+    workers: int
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class RunInfo:
     id: str
     suite: str
+    url: str  # The URL of the directory with the run's files.
+    safe_id: str = field(init=False)  # The id escaped for use as a directory name.
 
-    def path_safe_id(self):
-        return urllib.parse.quote(self.id, safe="")
+    def __post_init__(self):
+        object.__setattr__(self, "safe_id", urllib.parse.quote(self.id, safe=""))
 
 
 def run(args: Args):
     projects = PROJECTS if args.project_id == "all" else [args.project_id]
-    for project_id in projects:
-        download_project(project_id, args)
+    # All projects share the session's connections, which are closed once everything is done.
+    with SESSION:
+        if len(projects) > 1 and (args.release == "latest" or args.storage_url is None):
+            # Fetch the config.js of all projects at once, instead of one round trip per project.
+            # Failures are not cached, and are reported when the project's turn comes.
+            with ThreadPoolExecutor() as executor:
+                for project_id in projects:
+                    executor.submit(get_config_js, project_id)
+        for project_id in projects:
+            download_project(project_id, args)
+
+
+@functools.lru_cache(maxsize=None)
+def get_config_js(project: str) -> str:
+    """Fetch a project's config.js, which holds both its latest release and its storage URL."""
+    url = f"https://crfm.stanford.edu/helm/{project}/latest/config.js"
+    return SESSION.get(url, timeout=TIMEOUT).text
 
 
 def download_project(project: str, args: Args):
@@ -116,13 +151,11 @@ def download_project(project: str, args: Args):
 
     print(f"# Downloading data for HELM {PROJECT_INFO[project]['name']} project.")
     project_info = PROJECT_INFO[project]
-    config_url = f"https://crfm.stanford.edu/helm/{project}/latest/config.js"
 
     # Get version
     if args.release == "latest":
         try:
-            config_js = requests.get(config_url)
-            release_re = re.search(project_info["release_regex"], config_js.text)
+            release_re = project_info["release_regex"].search(get_config_js(project))
             release = release_re.group(1)  # type: ignore
             print(f"Using latest release, which is found to be '{release}'.")
         except Exception:
@@ -135,16 +168,13 @@ def download_project(project: str, args: Args):
     # Get storage url
     if args.storage_url is None:
         try:
-            config_js = requests.get(config_url)
-            storage_url_re = re.search(
-                r'window.BENCHMARK_OUTPUT_BASE_URL =\s+"(.*)";',
-                config_js.text,
-            )
+            storage_url_re = STORAGE_URL_RE.search(get_config_js(project))
             storage_url = storage_url_re.group(1)  # type: ignore
             print(f"Found storage URL '{storage_url}'.")
         except Exception:
             print("Could not find storage URL automatically. ", end="")
             print("Try setting it manually with e.g. `--storage-url https://example.com`.")
+            sys.exit(1)
     else:
         storage_url = args.storage_url
 
@@ -153,48 +183,58 @@ def download_project(project: str, args: Args):
     storage_url = f"{storage_url}"
     release_url = project_info["get_release_url"](storage_url, release)
 
-    # Get run ids
-    print(f"Getting run ids from '{release_url}/run_specs.json")
-    try:
-        run_specs = requests.get(f"{release_url}/run_specs.json").json()
-    except json.JSONDecodeError as e:
-        print(f"Could not find run specs for release '{release}'.")
-        print("-------------- BEGIN HTML --------------")
-        print(e.doc)
-        print("-------------- END HTML --------------")
-        print("You'll have to fix the code yourself.")
-        sys.exit(1)
-    run_ids = [run_spec["name"] for run_spec in run_specs]
-
-    # Get run to suite mapping
-    if project != "heim":
-        print(f"Getting run to suite mapping from {release_url}/runs_to_run_suites.json")  # fmt: skip
-        runs_to_run_suites = requests.get(f"{release_url}/runs_to_run_suites.json").json()  # fmt: skip
-        runs = [RunInfo(id=id, suite=runs_to_run_suites[id]) for id in run_ids]
-    else:
-        runs = [RunInfo(id=id, suite=release) for id in run_ids]
-
     # Configure outputs
     output_dir = args.output_dir or Path(f"./helm-data/{project}/{release}/")
-    output_dir.mkdir(parents=True, exist_ok=True)
     if args.files == ["all"]:
         run_files = FILES
     else:
         assert all(file in FILES for file in args.files), f"Unknown file in {args.files}."  # fmt: skip
         run_files = args.files
 
-    # Manage already downloaded runs
-    def is_downloaded(run: RunInfo):
-        run_dir = output_dir / run.path_safe_id()
-        return all((run_dir / f"{file}").exists() for file in run_files)
+    # Get run ids and run to suite mapping, while indexing already downloaded runs in the meantime
+    print(f"Getting run ids from '{release_url}/run_specs.json")
+    if project != "heim":
+        print(f"Getting run to suite mapping from {release_url}/runs_to_run_suites.json")  # fmt: skip
+    with ThreadPoolExecutor() as executor:
+        run_ids_future = executor.submit(get_run_ids, release_url, release)
+        if project != "heim":
+            runs_to_run_suites_future = executor.submit(
+                get_runs_to_run_suites, release_url, release
+            )
 
-    already_downloaded = set(run.id for run in runs if is_downloaded(run))
-    runs_to_download = [run for run in runs if run.id not in already_downloaded]
-    runs_to_download = sorted(runs_to_download, key=lambda run: run.id)
+        # A dry run leaves the output directory untouched.
+        if not args.dry_run:
+            output_dir.mkdir(parents=True, exist_ok=True)
+        downloaded = index_downloaded(output_dir, rescan=args.rescan, save=not args.dry_run)
+        required_files = set(run_files)
+        downloaded_ids = {
+            safe_id for safe_id, files in downloaded.items() if required_files <= files
+        }
+
+        run_ids = run_ids_future.result()
+        if project != "heim":
+            runs_to_run_suites = runs_to_run_suites_future.result()
+            suites = [runs_to_run_suites[id] for id in run_ids]
+        else:
+            suites = [release] * len(run_ids)
+        runs = [
+            RunInfo(id=id, suite=suite, url=f"{storage_url}/runs/{suite}/{id}")
+            for id, suite in zip(run_ids, suites)
+        ]
+
+    # Manage already downloaded runs
+    already_downloaded = [run for run in runs if run.safe_id in downloaded_ids]
+    if args.redownload:
+        runs_to_download = runs
+    else:
+        runs_to_download = [run for run in runs if run.safe_id not in downloaded_ids]
+    # Group runs by suite, so consecutive requests share a URL prefix (and warm caches)
+    runs_to_download = sorted(runs_to_download, key=lambda run: (run.suite, run.id))
     print(f"Found {len(runs)} runs online.", end=" ")
     print(f"Found {len(already_downloaded)} runs already downloaded.")
     if args.redownload:
-        print(f"Redownload flag set. Downloading all {len(runs_to_download)} runs.")
+        print(f"Redownload flag set. Downloading all {len(runs_to_download)} runs.", end=" ")
+        print("Files unchanged since they were downloaded are skipped.")
     else:
         print(f"Downloading remaining {len(runs_to_download)} runs.")
     if args.max_runs is not None:
@@ -203,25 +243,59 @@ def download_project(project: str, args: Args):
         print("NOTE: Dry run. Not downloading any runs.")
 
     # Download runs
-    output_dir.mkdir(parents=True, exist_ok=True)
-    for run in tqdm(runs_to_download[: args.max_runs]):
-        if args.dry_run:
-            continue
-
-        run_dir_path = output_dir / run.path_safe_id()
-        run_dir_path.mkdir(parents=True, exist_ok=True)
-
-        run_url = f"{storage_url}/runs/{run.suite}/{run.id}"
-        for file_name in run_files:
-            file_url = f"{run_url}/{file_name}"
-            file = requests.get(file_url)
-            if file.status_code == 200:
-                with open(run_dir_path / file_name, "wb") as f:
-                    f.write(file.content)
-            else:
-                with open(run_dir_path / f"{file_name}.error", "wb") as f:
-                    f.write(file.content)
-                raise Exception(f"Could not download {file_name} from {file_url}.")
+    runs_to_download = runs_to_download[: args.max_runs]
+    if args.dry_run:
+        return
+
+    # Start with the largest files of all runs, so no large download is left for the very end,
+    # when most workers would sit idle while it finishes.
+    jobs = [
+        (f"{run.url}/{file_name}", output_dir / run.safe_id / file_name)
+        for file_name in sorted(run_files, key=FILES_BY_SIZE.index)
+        for run in runs_to_download
+    ]
+    download_files(jobs, output_dir, workers=args.workers, indexed=downloaded)
+
+
+def get_run_ids(release_url: str, release: str) -> list[str]:
+    """Get the ids of all runs in a release, picked from the (large) run specs as they come in."""
+    with SESSION.get(f"{release_url}/run_specs.json", stream=True, timeout=TIMEOUT) as response:
+        if response.status_code != 200:
+            exit_with_html(f"Could not find run specs for release '{release}'.", response.text)
+        response.raw.decode_content = True
+        try:
+            return list(ijson.items(response.raw, "item.name"))
+        except ijson.JSONError as e:
+            # The response is consumed while parsing, so show the part around the error instead.
+            exit_with_html(f"Could not find run specs for release '{release}'.", str(e))
+
+
+def get_runs_to_run_suites(release_url: str, release: str) -> Dict[str, str]:
+    """Get the mapping from run ids to the suite (i.e. release) each run was last run in."""
+    message = f"Could not find run to suite mapping for release '{release}'."
+    response = SESSION.get(f"{release_url}/runs_to_run_suites.json", timeout=TIMEOUT)
+    if response.status_code != 200:
+        exit_with_html(message, response.text)
+    try:
+        return orjson.loads(response.content)
+    except orjson.JSONDecodeError as e:
+        exit_with_html(message, e.doc)
+
+
+def exit_with_html(message: str, html: str) -> NoReturn:
+    print(message)
+    print("-------------- BEGIN HTML --------------")
+    print(html)
+    print("-------------- END HTML --------------")
+    print("You'll have to fix the code yourself.")
+    sys.exit(1)
+
+
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, not {number}")
+    return number
 
 
 def get_parser():
@@ -261,12 +335,24 @@ def get_parser():
     parser.add_argument(
         "--redownload",
         action="store_true",
-        help="Redownload all data, even if present already.",
+        help="Redownload all data, even if present already. Files unchanged on the server are skipped.",
     )
     parser.add_argument(
         "--max-runs", type=int, default=None, help="Maximum number of runs to download."
     )
     parser.add_argument("--dry-run", action="store_true", help="Dry run. Do not download any runs.")
+    parser.add_argument(
+        "--rescan",
+        action="store_true",
+        help="Find already downloaded runs by listing the output directory, "
+        + "instead of trusting its manifest. Use this after changing files in it manually.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=positive_int,
+        default=64,
+        help="Number of files to download concurrently. Default: 64.",
+    )
 
     default_files = [
         "scenario_state.json",